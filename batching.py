@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+import aiohttp
+
+import cache
+
+
+def estimated_tokens(prompt, max_tokens):
+    # Roughly four characters per token for English text
+    return len(prompt) // 4 + max_tokens
+
+
+class CompletionBatcher:
+    # Coalesces completion requests that differ only in their prompt into one
+    # multi-prompt request. The first request for a given (url, parameters)
+    # opens a batch that is sent after `window` seconds, or earlier once it
+    # holds max_prompts prompts. Requests whose estimated tokens would exceed
+    # max_request_tokens are split across several API calls.
+    #
+    # The batcher runs its own event loop in a background thread so that
+    # requests from different threads (e.g. Streamlit sessions, each with its
+    # own event loop) end up in the same batches.
+
+    def __init__(self, headers, window=0.02, max_prompts=20, max_request_tokens=20_000):
+        self.headers = headers
+        self.window = window
+        self.max_prompts = max_prompts
+        self.max_request_tokens = max_request_tokens
+        self.pending = {}
+        self.in_flight = {}
+        self.loop = None
+        self.session = None
+        self.requests_sent = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is not None:
+                return
+            started = threading.Event()
+
+            def serve():
+                self.loop = asyncio.new_event_loop()
+                self.session = self.loop.run_until_complete(self.create_session())
+                started.set()
+                self.loop.run_forever()
+
+            threading.Thread(target=serve, name="completion-batcher", daemon=True).start()
+            started.wait()
+
+    async def create_session(self):
+        return aiohttp.ClientSession(headers=self.headers)
+
+    async def submit(self, url, data):
+        # Returns a single-prompt completion response ({"choices": [choice]}),
+        # plus the usage of the whole request and the number of prompts in it
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.enqueue(url, data), self.loop)
+        return await asyncio.wrap_future(future)
+
+    async def enqueue(self, url, data):
+        # Identical requests that are already queued or in flight share the
+        # first one's result. shield() keeps one caller's timeout from
+        # cancelling the result for the others.
+        request_key = cache.make_key(url, data)
+        if request_key in self.in_flight:
+            return await asyncio.shield(self.in_flight[request_key])
+        params = {key: value for (key, value) in data.items() if key != "prompt"}
+        key = cache.make_key(url, params)
+        result = self.in_flight[request_key] = self.loop.create_future()
+        result.add_done_callback(lambda _: self.in_flight.pop(request_key, None))
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = []
+            self.loop.call_later(self.window, self.flush, key, batch, url, params)
+        batch.append((data["prompt"], result))
+        if len(batch) >= self.max_prompts:
+            self.flush(key, batch, url, params)
+        return await asyncio.shield(result)
+
+    def flush(self, key, batch, url, params):
+        # Called by the window timer and when a batch fills up; whichever
+        # comes second finds the batch already gone
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        for chunk in self.chunks(batch, params.get("max_tokens", 16)):
+            self.loop.create_task(self.send(url, params, chunk))
+
+    def chunks(self, batch, max_tokens):
+        chunk, chunk_tokens = [], 0
+        for (prompt, result) in batch:
+            tokens = estimated_tokens(prompt, max_tokens)
+            if chunk and chunk_tokens + tokens > self.max_request_tokens:
+                yield chunk
+                chunk, chunk_tokens = [], 0
+            chunk.append((prompt, result))
+            chunk_tokens += tokens
+        if chunk:
+            yield chunk
+
+    async def send(self, url, params, chunk):
+        data = dict(params, prompt=[prompt for (prompt, result) in chunk])
+        self.requests_sent += 1
+        try:
+            async with self.session.post(url, json=data) as response:
+                completion_result = await response.json(content_type=None)
+        except Exception as e:
+            for (prompt, result) in chunk:
+                if not result.done():
+                    result.set_exception(e)
+            return
+        choices = {choice.get("index"): choice for choice in completion_result.get("choices") or []}
+        for (i, (prompt, result)) in enumerate(chunk):
+            if result.done():
+                continue
+            if i in choices:
+                # usage covers the whole request; callers split it by batch_size
+                result.set_result(
+                    {
+                        "choices": [choices[i]],
+                        "usage": completion_result.get("usage", {}),
+                        "batch_size": len(chunk),
+                    }
+                )
+            else:
+                # Pass errors through so callers handle them like a failed
+                # single request
+                result.set_result({key: value for (key, value) in completion_result.items() if key != "choices"})
@@ -0,0 +1,390 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+
+import papers
+
+
+default_questions = [
+    "How can I summarize long documents?",
+    "Do neurons behave like deep networks?",
+    "How can we reduce data labeling cost?",
+    "What datasets exist for question answering?",
+    "Does learning in high dimensions require extrapolation?",
+]
+
+methods = ["a transformer", "a retrieval model", "contrastive pretraining", "a sparse autoencoder", "active learning", "a graph network"]
+tasks = ["document summarization", "question answering", "image synthesis", "neural recording analysis", "data labeling", "protein folding"]
+metrics = ["accuracy", "ROUGE", "F1", "sample efficiency", "latency", "calibration"]
+
+
+def synthetic_papers(n, seed=0):
+    rng = random.Random(seed)
+    synthetic = []
+    for i in range(n):
+        method, task = rng.choice(methods), rng.choice(tasks)
+        sentences = [
+            f"We study {task} with {method}.",
+            f"Prior work on {task} relies on {rng.choice(methods)}, which scales poorly.",
+            f"We propose a variant of {method} that improves {rng.choice(metrics)} by {rng.randint(2, 40)}%.",
+            f"Experiments on {rng.randint(2, 9)} benchmarks show consistent gains over strong baselines.",
+            f"Our analysis suggests that {rng.choice(metrics)} is limited by {rng.choice(tasks)} data quality.",
+        ]
+        synthetic.append(
+            papers.Paper(
+                title=f"{method.capitalize()} for {task} ({i})",
+                abstract=" ".join(rng.sample(sentences, rng.randint(3, 5))),
+            )
+        )
+    return synthetic
+
+
+def default_fixtures(num_synthetic=40):
+    corpus = papers.neuro + papers.machine_learning + synthetic_papers(num_synthetic)
+    fixtures = {"papers": []}
+    for (i, paper) in enumerate(corpus):
+        paper_id = hashlib.sha1(paper.title.encode("utf-8")).hexdigest()
+        fixture = {"paperId": paper_id, "title": paper.title, "abstract": paper.abstract}
+        # Half the Google Scholar results link to a DOI
+        if i % 2 == 0:
+            fixture["doi"] = f"10.5555/{paper_id[:12]}"
+        fixtures["papers"].append(fixture)
+    return fixtures
+
+
+def fake_completion_text(prompt):
+    # First words of the last context in the prompt, as a stand-in claim
+    context = prompt.rsplit("Context:", 1)[-1].strip().strip('"').split("\n")[0]
+    return " " + " ".join(context.split()[:12])
+
+
+class StandInServer:
+    # Serves SerpAPI, Semantic Scholar and OpenAI completion endpoints from
+    # fixtures, with a fixed artificial latency per request
+
+    def __init__(self, fixtures, latency=0.05, port=0):
+        self.papers = {paper["paperId"]: paper for paper in fixtures["papers"]}
+        self.by_title = {paper["title"]: paper for paper in fixtures["papers"]}
+        self.by_external_id = {
+            f"DOI:{paper['doi']}": paper for paper in fixtures["papers"] if paper.get("doi")
+        }
+        self.latency = latency
+        self.port = port
+        self.loop = None
+        self.runner = None
+        self.requests = {"serpapi": 0, "semantic_scholar": 0, "openai": 0}
+
+    def scholar_results(self, question, num):
+        # Deterministically pick papers per question, scored by word overlap
+        words = set(question.lower().split())
+
+        def overlap(paper):
+            text = (paper["title"] + " " + paper["abstract"]).lower()
+            tiebreak = hashlib.sha1((question + paper["paperId"]).encode("utf-8")).hexdigest()
+            return (-sum(word in text for word in words), tiebreak)
+
+        ranked = sorted(self.papers.values(), key=overlap)
+        return [
+            {"title": paper["title"], "link": f"https://doi.org/{paper['doi']}"}
+            if paper.get("doi")
+            else {"title": paper["title"]}
+            for paper in ranked[:num]
+        ]
+
+    async def serpapi_search(self, request):
+        from aiohttp import web
+
+        self.requests["serpapi"] += 1
+        await asyncio.sleep(self.latency)
+        num = int(request.query.get("num", 10))
+        return web.json_response(
+            {"organic_results": self.scholar_results(request.query.get("q", ""), num)}
+        )
+
+    async def paper_search(self, request):
+        from aiohttp import web
+
+        self.requests["semantic_scholar"] += 1
+        await asyncio.sleep(self.latency)
+        paper = self.by_title.get(request.query.get("query"))
+        fields = ["paperId"] + request.query.get("fields", "title").split(",")
+        data = [{field: paper.get(field) for field in fields}] if paper else []
+        return web.json_response({"total": len(data), "data": data})
+
+    async def paper_batch(self, request):
+        from aiohttp import web
+
+        self.requests["semantic_scholar"] += 1
+        await asyncio.sleep(self.latency)
+        fields = ["paperId"] + request.query.get("fields", "title").split(",")
+        papers = [self.by_external_id.get(paper_id) for paper_id in (await request.json())["ids"]]
+        return web.json_response(
+            [{field: paper.get(field) for field in fields} if paper else None for paper in papers]
+        )
+
+    async def paper_detail(self, request):
+        from aiohttp import web
+
+        self.requests["semantic_scholar"] += 1
+        await asyncio.sleep(self.latency)
+        paper = self.papers.get(request.match_info["paper_id"])
+        if paper is None:
+            return web.json_response({"error": "Paper not found"}, status=404)
+        return web.json_response(paper)
+
+    async def completions(self, request):
+        from aiohttp import web
+
+        self.requests["openai"] += 1
+        await asyncio.sleep(self.latency)
+        data = await request.json()
+        prompts = data["prompt"] if isinstance(data["prompt"], list) else [data["prompt"]]
+        choices = []
+        for (i, prompt) in enumerate(prompts):
+            if data.get("logprobs"):
+                text = " Yes\n" + fake_completion_text(prompt).strip()
+                logprobs = {"top_logprobs": [{" Yes": -0.2, " No": -1.8, " Not": -3.5}]}
+            else:
+                text, logprobs = fake_completion_text(prompt), None
+            choices.append({"index": i, "text": text, "logprobs": logprobs})
+        if data.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            for choice in choices:
+                for word in choice["text"].split(" "):
+                    event = {"choices": [{"index": choice["index"], "text": word + " "}]}
+                    await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            await response.write(b"data: [DONE]\n\n")
+            return response
+        prompt_tokens = sum(len(prompt.split()) for prompt in prompts)
+        completion_tokens = sum(len(choice["text"].split()) for choice in choices)
+        return web.json_response(
+            {
+                "choices": choices,
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+        )
+
+    async def start_app(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/search", self.serpapi_search)
+        app.router.add_get("/search.json", self.serpapi_search)
+        app.router.add_get("/graph/v1/paper/search", self.paper_search)
+        app.router.add_post("/graph/v1/paper/batch", self.paper_batch)
+        app.router.add_get("/graph/v1/paper/{paper_id}", self.paper_detail)
+        app.router.add_post("/v1/completions", self.completions)
+        app.router.add_post("/v1/engines/{engine}/completions", self.completions)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start_app())
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=serve, name="stand-in-server", daemon=True).start()
+        started.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def point_at(base_url, workdir):
+    # Route all API traffic to the stand-in server and keep caches out of the
+    # user's real cache directory
+    import compression
+    import retrieval
+
+    retrieval.serpapi_url = base_url
+    retrieval.semantic_scholar_url = f"{base_url}/graph/v1"
+    compression.openai_url = f"{base_url}/v1"
+    for key in ["semantic_scholar_api_key", "serpapi_api_key", "openai_api_key"]:
+        os.environ.setdefault(key, "bench")
+    os.environ["fast_claims_cache_path"] = os.path.join(workdir, "cache.sqlite")
+    os.environ["fast_claims_embeddings_path"] = os.path.join(workdir, "embeddings")
+    os.environ["fast_claims_paper_store_path"] = os.path.join(workdir, "papers.sqlite")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(q * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(samples):
+    return {
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def bench_model(claim_pipeline, server, questions, config, repeat):
+    stage_samples = {}
+    totals = []
+    requests_before = dict(server.requests)
+    # claim_pipeline should be fresh (see main), so the first pass runs with
+    # cold caches and an empty paper store; later passes hit them
+    for iteration in range(repeat):
+        for question in questions:
+            start = time.perf_counter()
+            result = claim_pipeline.run(question, config)
+            totals.append(time.perf_counter() - start)
+            for (stage, seconds) in result.timings.items():
+                stage_samples.setdefault(stage, []).append(seconds)
+    return {
+        "runs": len(totals),
+        "throughput_qps": round(len(totals) / sum(totals), 3),
+        "total": summarize(totals),
+        "stages": {stage: summarize(samples) for (stage, samples) in stage_samples.items()},
+        "requests_per_question": {
+            api: round((count - requests_before.get(api, 0)) / len(totals), 2)
+            for (api, count) in server.requests.items()
+            if count > requests_before.get(api, 0)
+        },
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for (model, result) in results["models"].items():
+        baseline_result = baseline.get("models", {}).get(model)
+        if baseline_result is None:
+            continue
+        stages = dict(result["stages"], total=result["total"])
+        baseline_stages = dict(baseline_result["stages"], total=baseline_result["total"])
+        for (stage, summary) in stages.items():
+            before = baseline_stages.get(stage, {}).get("p50_ms")
+            after = summary["p50_ms"]
+            if before and after > before * (1 + threshold):
+                regressions.append(
+                    {"model": model, "stage": stage, "baseline_p50_ms": before, "p50_ms": after}
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    import compression
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the claim pipeline against a local stand-in for SerpAPI, Semantic Scholar and OpenAI."
+    )
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=[m for m in compression.summarization_models if m != "t5-one-line-summary"],
+        help="Summarization models to benchmark (T5 is excluded by default)",
+    )
+    parser.add_argument("--summarization-input", default="best sentence", choices=compression.summarization_inputs)
+    parser.add_argument("--questions", help="JSONL file of {\"question\": ...} objects")
+    parser.add_argument("--fixtures", help="JSON fixtures file (default: sample corpora plus synthetic abstracts)")
+    parser.add_argument("--write-fixtures", help="Write the default fixtures to this path and exit")
+    parser.add_argument("--synthetic-papers", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=50, help="Artificial latency per API request")
+    parser.add_argument("--repeat", type=int, default=2, help="Passes over the questions; the first one is cold")
+    parser.add_argument("--stream", action="store_true", help="Stream completions")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--baseline", help="Earlier --output file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative p50 slowdown that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.write_fixtures:
+        with open(args.write_fixtures, "w") as f:
+            json.dump(default_fixtures(args.synthetic_papers), f, indent=2)
+        return 0
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+    else:
+        fixtures = default_fixtures(args.synthetic_papers)
+    if args.questions:
+        with open(args.questions) as f:
+            questions = [json.loads(line)["question"] for line in f if line.strip()]
+    else:
+        questions = default_questions
+
+    server = StandInServer(fixtures, latency=args.latency_ms / 1000)
+    base_url = server.start()
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "settings": {
+            "questions": len(questions),
+            "papers": len(fixtures["papers"]),
+            "latency_ms": args.latency_ms,
+            "repeat": args.repeat,
+            "stream": args.stream,
+            "summarization_input": args.summarization_input,
+        },
+        "models": {},
+    }
+    try:
+        results["startup"] = {}
+        for model in args.models:
+            # Every model gets its own pipeline and working directory, so no
+            # caches, memos, embeddings or stored papers carry over from the
+            # models benchmarked before it
+            with tempfile.TemporaryDirectory() as workdir:
+                point_at(base_url, workdir)
+                import pipeline
+
+                claim_pipeline = pipeline.ClaimPipeline.from_env()
+                config = pipeline.PipelineConfig(
+                    summarization_model=model,
+                    summarization_input=args.summarization_input,
+                    stream=args.stream,
+                )
+                results["models"][model] = bench_model(
+                    claim_pipeline, server, questions, config, args.repeat
+                )
+                results["startup"][model] = claim_pipeline.startup_report()
+                t5_summarizer = claim_pipeline.resources["t5_model"]
+                if t5_summarizer.loaded:
+                    t5_summarizer.value.shutdown()
+            print(f"{model}: {json.dumps(results['models'][model]['total'])}", file=sys.stderr)
+    finally:
+        server.stop()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["regressions"] = find_regressions(results, json.load(f), args.threshold)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 1 if results.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
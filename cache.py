@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+missing = object()
+
+
+def make_key(*parts):
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    # SQLite-backed key/value store for JSON-serializable values, with LRU
+    # eviction once more than max_entries are stored and an optional TTL
+    # (in seconds) after which entries are treated as missing.
+
+    def __init__(self, path, max_entries=100_000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+            )
+
+    def get(self, key, default=missing):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return default
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            (count,) = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if count > self.max_entries:
+                self.connection.execute(
+                    """
+                    DELETE FROM entries WHERE key IN (
+                        SELECT key FROM entries ORDER BY accessed_at LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                )
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM entries")
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
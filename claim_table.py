@@ -0,0 +1,127 @@
+import numpy as np
+
+
+class ClaimRow:
+    # A view of one sentence in a ClaimTable. Only rows that are looked at
+    # (e.g. the candidates for reranking) are ever created.
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def text(self):
+        return self.table.texts[self.index]
+
+    @property
+    def paper(self):
+        return self.table.papers[self.table.paper_index[self.index]]
+
+    @property
+    def offset(self):
+        # Position of the sentence in its abstract
+        return int(self.table.offsets[self.index])
+
+    def __repr__(self):
+        return self.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __eq__(self, other):
+        if not isinstance(other, ClaimRow):
+            return False
+        return self.text == other.text
+
+    def __lt__(self, other):
+        return self.text < other.text
+
+
+class ClaimTable:
+    # The sentences of a set of papers, stored column-wise: texts, the index
+    # of each sentence's paper and its position in the abstract. A sentence
+    # that occurs in several abstracts is kept once, for the first paper.
+
+    def __init__(self, papers, sentences_per_paper):
+        self.papers = list(papers)
+        self.texts = []
+        paper_index = []
+        offsets = []
+        rows = {}
+        for (i, sentences) in enumerate(sentences_per_paper):
+            for (offset, text) in enumerate(sentences):
+                if rows.setdefault(text, len(self.texts)) != len(self.texts):
+                    continue
+                self.texts.append(text)
+                paper_index.append(i)
+                offsets.append(offset)
+        self.paper_index = np.array(paper_index, dtype=np.int32)
+        self.offsets = np.array(offsets, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, index):
+        return ClaimRow(self, int(index))
+
+    def __iter__(self):
+        return (ClaimRow(self, i) for i in range(len(self.texts)))
+
+    def ranked(self, scores):
+        return RankedClaims(self, np.asarray(scores, dtype=np.float32))
+
+
+class RankedClaims:
+    # (score, claim) pairs of a ClaimTable in descending score order.
+    # Iteration orders the rows a block at a time with np.partition, so
+    # consumers that stop after the best few claims never sort the rest.
+    # Ties are broken by table order.
+
+    first_block = 64
+
+    def __init__(self, table, scores, rows=None):
+        self.table = table
+        self.scores = scores
+        self.rows = np.arange(len(table)) if rows is None else rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        rows = self.rows
+        row_scores = self.scores[rows]
+        k = self.first_block
+        while len(rows):
+            if k < len(rows):
+                # Rows tied with the k-th best score go in the same block
+                kth_score = -np.partition(-row_scores, k - 1)[k - 1]
+                in_block = row_scores >= kth_score
+                (top, rest) = (np.flatnonzero(in_block), np.flatnonzero(~in_block))
+            else:
+                (top, rest) = (np.arange(len(rows)), np.arange(0))
+            top = top[np.lexsort((rows[top], -row_scores[top]))]
+            for i in top:
+                yield float(row_scores[i]), ClaimRow(self.table, int(rows[i]))
+            (rows, row_scores) = (rows[rest], row_scores[rest])
+            k *= 4
+
+    def papers(self):
+        # The papers that still have claims, in table order
+        present = np.unique(self.table.paper_index[self.rows])
+        return [self.table.papers[i] for i in present]
+
+    def best_paper_scores(self):
+        # The score of each paper's best claim, best first
+        paper_index = self.table.paper_index[self.rows]
+        best = np.full(len(self.table.papers), -np.inf, dtype=np.float32)
+        np.maximum.at(best, paper_index, self.scores[self.rows])
+        best = best[np.unique(paper_index)]
+        return [float(score) for score in np.sort(best)[::-1]]
+
+    def where_papers(self, papers):
+        # Only the claims of the given papers
+        keep = np.array([paper in papers for paper in self.table.papers], dtype=bool)
+        rows = self.rows[keep[self.table.paper_index[self.rows]]] if len(self.rows) else self.rows
+        return RankedClaims(self.table, self.scores, rows)
@@ -0,0 +1,120 @@
+import argparse
+import dataclasses
+import json
+import sys
+
+import compression
+import pipeline
+import scoring
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract claims for each question in a JSONL file."
+    )
+    parser.add_argument(
+        "input",
+        help='JSONL file with one {"question": ...} object per line, or - for stdin',
+    )
+    parser.add_argument(
+        "output", nargs="?", default="-", help="JSONL output file (default: stdout)"
+    )
+    parser.add_argument(
+        "--summarization-model",
+        default="best sentence",
+        choices=compression.summarization_models,
+    )
+    parser.add_argument(
+        "--summarization-input",
+        default="best sentence",
+        choices=compression.summarization_inputs,
+    )
+    parser.add_argument("--papers-available", type=int, default=15)
+    parser.add_argument("--papers-shown", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument(
+        "--local-first",
+        action="store_true",
+        help="Answer from the local paper store when it has enough matching papers",
+    )
+    parser.add_argument(
+        "--filter-model",
+        default=None,
+        choices=list(scoring.probabilistic_models),
+        help="Drop papers this model thinks don't answer the question",
+    )
+    parser.add_argument("--min-yes-probability", type=float, default=0.5)
+    parser.add_argument(
+        "--max-input-tokens",
+        type=int,
+        default=None,
+        help="Cut full abstracts to about this many tokens, keeping the most relevant sentences",
+    )
+    parser.add_argument(
+        "--latency-budget",
+        type=float,
+        default=None,
+        help="Seconds per question; stages that would overrun it are skipped",
+    )
+    parser.add_argument(
+        "--initial-papers",
+        type=int,
+        default=None,
+        help="Fetch this many papers first and the rest only if too few look relevant",
+    )
+    parser.add_argument("--saturation-score", type=float, default=0.5)
+    parser.add_argument(
+        "--rerank-margin",
+        type=float,
+        default=None,
+        help="Skip reranking when first-stage scores separate the papers shown by this much",
+    )
+    parser.add_argument(
+        "--min-claim-score",
+        type=float,
+        default=None,
+        help="Drop reranked claims scoring below this before compressing them",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = pipeline.PipelineConfig(
+        num_papers_available=args.papers_available,
+        num_papers_shown=args.papers_shown,
+        summarization_model=args.summarization_model,
+        summarization_input=args.summarization_input,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        local_first=args.local_first,
+        filter_model=args.filter_model,
+        min_yes_probability=args.min_yes_probability,
+        max_input_tokens=args.max_input_tokens,
+        latency_budget=args.latency_budget,
+        initial_papers=args.initial_papers,
+        saturation_score=args.saturation_score,
+        rerank_margin=args.rerank_margin,
+        min_claim_score=args.min_claim_score,
+    )
+    claim_pipeline = pipeline.ClaimPipeline.from_env()
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+    with infile, outfile:
+        for line in infile:
+            if not line.strip():
+                continue
+            question = json.loads(line)["question"]
+            result = claim_pipeline.run(question, config)
+            outfile.write(json.dumps(dataclasses.asdict(result)) + "\n")
+            outfile.flush()
+    for (name, seconds) in claim_pipeline.startup_report().items():
+        if seconds is not None:
+            print(f"Loaded {name} in {seconds:.1f}s", file=sys.stderr)
+    for (name, totals) in claim_pipeline.prompt_builder.stats().items():
+        print(f"{name}: {totals['prompts']} prompts, {totals['tokens']} tokens", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
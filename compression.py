@@ -0,0 +1,311 @@
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+import batching
+import cache
+import prompting
+import scoring
+import tracing
+
+
+openai_url = os.environ.get("openai_url", "https://api.openai.com/v1")
+
+summarization_models = [
+    "best sentence",
+    "davinci:ft-ought-1-2021-10-26-18-39-48",
+    "curie:ft-ought-1-2021-10-22-00-52-45",
+    "babbage:ft-ought-1-2021-10-22-01-05-15",
+    "ada:ft-ought-1-2021-10-22-00-42-58",
+    "t5-one-line-summary",
+    "davinci-instruct-beta-v2-few-shot",
+    "probabilistic-davinci-v2",
+    "probabilistic-curie-v2",
+]
+
+summarization_inputs = ["best sentence", "full abstract"]
+
+
+class Completer:
+    # With a batch_window (seconds), non-streaming requests are coalesced into
+    # multi-prompt requests by a CompletionBatcher shared by all callers
+
+    def __init__(self, api_key, result_cache=None, batch_window=None):
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.result_cache = result_cache
+        self.batcher = None
+        if batch_window:
+            self.batcher = batching.CompletionBatcher(self.headers, window=batch_window)
+
+    async def complete(self, session, url, data):
+        key = cache.make_key("completion", url, data)
+        with tracing.span("completion", model=data.get("model", url)) as span:
+            if self.result_cache is not None:
+                completion_result = self.result_cache.get(key)
+                if completion_result is not cache.missing:
+                    span.set(cache_hit=True)
+                    return completion_result
+            if self.batcher is not None:
+                completion_result = await self.batcher.submit(url, data)
+                batch_size = completion_result.get("batch_size") or 1
+                usage = completion_result.get("usage", {})
+                # Token counts are for the whole batch; record this prompt's
+                # even share of them
+                span.set(
+                    cache_hit=False,
+                    batch_size=batch_size,
+                    prompt_tokens=round(usage["prompt_tokens"] / batch_size)
+                    if "prompt_tokens" in usage
+                    else None,
+                    completion_tokens=round(usage["completion_tokens"] / batch_size)
+                    if "completion_tokens" in usage
+                    else None,
+                )
+            else:
+                async with session.post(url, json=data, headers=self.headers) as response:
+                    completion_result = await response.json(content_type=None)
+                usage = completion_result.get("usage", {})
+                span.set(
+                    cache_hit=False,
+                    prompt_tokens=usage.get("prompt_tokens"),
+                    completion_tokens=usage.get("completion_tokens"),
+                )
+            if self.result_cache is not None and completion_result.get("choices"):
+                self.result_cache.set(key, completion_result)
+            return completion_result
+
+    async def stream(self, session, url, data):
+        # Yields text chunks of a single completion as they are generated,
+        # using OpenAI's server-sent events. Shares cache entries with complete().
+        key = cache.make_key("completion", url, data)
+        # Not a `with tracing.span(...)`: the span would stay current across
+        # the yields, in the consumer's context
+        span = tracing.start_span("completion", model=data.get("model", url), stream=True)
+        try:
+            if self.result_cache is not None:
+                completion_result = self.result_cache.get(key)
+                if completion_result is not cache.missing:
+                    span.set(cache_hit=True)
+                    yield completion_result["choices"][0]["text"]
+                    return
+            span.set(cache_hit=False)
+            chunks = []
+            async with session.post(
+                url, json={**data, "stream": True}, headers=self.headers
+            ) as response:
+                async for line in response.content:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    choices = json.loads(payload).get("choices")
+                    if choices:
+                        if not chunks:
+                            first_token_ns = time.time_ns() - span.start_time_ns
+                            span.set(first_token_ms=round(first_token_ns / 1e6, 3))
+                        chunks.append(choices[0]["text"])
+                        yield choices[0]["text"]
+            # The API streams one token per event
+            span.set(completion_tokens=len(chunks))
+            if self.result_cache is not None and chunks:
+                self.result_cache.set(key, {"choices": [{"text": "".join(chunks)}]})
+        except BaseException as e:
+            span.set(error=repr(e))
+            raise
+        finally:
+            span.end()
+
+
+async def completion_text(completer, session, url, data, on_text=None):
+    # With on_text, the completion is streamed and on_text is called with the
+    # text generated so far after every chunk
+    if on_text is None:
+        completion_result = await completer.complete(session, url, data)
+        choices = completion_result.get("choices")
+        if not choices:
+            return ""
+        return choices[0]["text"].strip()
+    text = ""
+    async for chunk in completer.stream(session, url, data):
+        text += chunk
+        on_text(text.strip())
+    return text.strip()
+
+
+def input_text(claim, input_type):
+    return claim.text if input_type == "best sentence" else claim.paper.abstract
+
+
+async def compress_claim_best_sentence(session, claim, question, on_text=None):
+    return claim.text
+
+
+async def compress_claim_probabilistic(completer, segmenter, session, claim, question, model):
+    prompt = scoring.probabilistic_prompt(segmenter, question, claim.paper)
+    data = {
+        "model": model,
+        "prompt": prompt,
+        "max_tokens": 200,
+        "stop": ["<end>"],
+        "temperature": 0,
+        "logprobs": scoring.top_logprobs,
+    }
+    completion_result = await completer.complete(session, f"{openai_url}/completions", data)
+    choices = completion_result.get("choices")
+    if not choices:
+        return "Err (no choices)"
+    response_text = choices[0]["text"].strip()
+    p = scoring.probability_of_yes(choices[0]["logprobs"]) * 100
+    if response_text.startswith("No"):
+        return f"[{p:.2f}%]"
+    else:
+        try:
+            answer = response_text.split("\n")[-1]
+        except Exception as e:
+            return f"Err ({response_text}): {e}"
+        else:
+            return f"[{p:.2f}%] {answer}"
+
+
+async def build_prompt(prompt_builder, name, claim, question, input_type, max_input_tokens):
+    # Tokenizing and ranking abstract sentences are blocking, so they run in
+    # a thread (with the current tracing span) instead of on the event loop
+    def build():
+        return prompt_builder.build(
+            name,
+            question=question,
+            claim_text=prompt_builder.input_text(claim, input_type, question, max_input_tokens),
+        )
+
+    return await asyncio.to_thread(build)
+
+
+async def compress_claim_finetuned(
+    completer, prompt_builder, session, claim, question, input_type, model, max_input_tokens=None, on_text=None
+):
+    prompt = await build_prompt(
+        prompt_builder, "fast_claim_compress_prompt", claim, question, input_type, max_input_tokens
+    )
+    data = {
+        "model": model,
+        "prompt": prompt,
+        "max_tokens": 200,
+        "stop": ["<end>", "\n", '"'],
+        "temperature": 0,
+    }
+    return await completion_text(
+        completer, session, f"{openai_url}/completions", data, on_text
+    )
+
+
+async def compress_claim_instruct(
+    completer, prompt_builder, session, claim, question, input_type, max_input_tokens=None, on_text=None
+):
+    prompt = await build_prompt(
+        prompt_builder, "claim_compress_prompt", claim, question, input_type, max_input_tokens
+    )
+    engine = "davinci-instruct-beta-v2"
+    data = {
+        "prompt": prompt,
+        "max_tokens": 200,
+        "stop": ["<end>", "\n", '"'],
+        "temperature": 0,
+    }
+    return await completion_text(
+        completer, session, f"{openai_url}/engines/{engine}/completions", data, on_text
+    )
+
+
+def make_compressor(
+    summarization_model,
+    summarization_input,
+    completer,
+    segmenter,
+    prompt_builder=None,
+    max_input_tokens=None,
+):
+    # Returns a coroutine function (session, claim, question, on_text=None) ->
+    # short claim, or None for the T5 model, which is run in batches by a
+    # summarizer.T5Summarizer. Compressors that produce free text stream it to
+    # on_text if it is given. Full-abstract inputs are cut to
+    # max_input_tokens by prompt_builder.
+    prompt_builder = prompt_builder or prompting.PromptBuilder(split=segmenter.split)
+    if summarization_model == "best sentence":
+        return compress_claim_best_sentence
+    if summarization_model in scoring.probabilistic_models:
+        model = scoring.probabilistic_models[summarization_model]
+        return lambda session, claim, question, on_text=None: compress_claim_probabilistic(
+            completer, segmenter, session, claim, question, model
+        )
+    if summarization_input not in summarization_inputs:
+        raise ValueError(summarization_input)
+    if summarization_model == "t5-one-line-summary":
+        return None
+    if summarization_model == "davinci-instruct-beta-v2-few-shot":
+        return lambda session, claim, question, on_text=None: compress_claim_instruct(
+            completer,
+            prompt_builder,
+            session,
+            claim,
+            question,
+            summarization_input,
+            max_input_tokens,
+            on_text,
+        )
+    if summarization_model not in summarization_models:
+        raise ValueError(summarization_model)
+    return lambda session, claim, question, on_text=None: compress_claim_finetuned(
+        completer,
+        prompt_builder,
+        session,
+        claim,
+        question,
+        summarization_input,
+        summarization_model,
+        max_input_tokens,
+        on_text,
+    )
+
+
+def timeout_result(claim, on_timeout=None):
+    return on_timeout(claim) if on_timeout is not None else "Err (timeout)"
+
+
+async def compress_claims(
+    claims, question, compressor, concurrency=8, timeout=30, on_partial=None, on_timeout=None
+):
+    # Yields (index, short_claim) pairs as soon as each compression finishes.
+    # If on_partial is given, completions are streamed and on_partial(index,
+    # text so far) is called as tokens arrive. A claim whose compression
+    # times out gets on_timeout(claim), or an error message without it.
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def compress(i, claim):
+            async with semaphore:
+                try:
+                    on_text = None
+                    if on_partial is not None:
+                        on_text = lambda text: on_partial(i, text)
+                    with tracing.span("compress_claim", index=i):
+                        short_claim = await asyncio.wait_for(
+                            compressor(session, claim, question, on_text), timeout
+                        )
+                except asyncio.TimeoutError:
+                    short_claim = timeout_result(claim, on_timeout)
+                except aiohttp.ClientError as e:
+                    short_claim = f"Err ({e})"
+            return i, short_claim
+
+        tasks = [compress(i, claim) for (i, claim) in enumerate(claims)]
+        for task in asyncio.as_completed(tasks):
+            yield await task
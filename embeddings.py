@@ -0,0 +1,90 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+
+def sentence_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingIndex:
+    # Sentence vectors live in a raw float32 file that is memory-mapped as an
+    # (n, dim) matrix, with row i belonging to the i-th hash in keys.txt. New
+    # sentences are embedded once and appended; vectors are normalized so a
+    # dot product is cosine similarity.
+
+    def __init__(self, model, path):
+        self.model = model
+        self.path = path
+        self.dim = model.get_sentence_embedding_dimension()
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.keys_path = os.path.join(path, "keys.txt")
+        self.vectors_path = os.path.join(path, "vectors.f32")
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                keys = f.read().split()
+        # Drop a partially written trailing vector or key, if any. Keys
+        # without a vector are also removed from keys.txt, so that keys
+        # appended later line up with their vectors again.
+        self.num_rows = min(len(keys), self.stored_rows())
+        if len(keys) > self.num_rows:
+            with open(self.keys_path, "w") as f:
+                f.write("".join(f"{key}\n" for key in keys[: self.num_rows]))
+        self.rows = {}
+        for (row, key) in enumerate(keys[: self.num_rows]):
+            self.rows.setdefault(key, row)
+        self.vectors = self.open_vectors(self.num_rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def stored_rows(self):
+        if not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (4 * self.dim)
+
+    def open_vectors(self, num_rows):
+        if num_rows == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(
+            self.vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim)
+        )
+
+    def encode(self, texts):
+        vectors = self.model.encode(texts, batch_size=64, convert_to_numpy=True)
+        vectors = vectors.astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        return vectors
+
+    def add(self, texts):
+        keys = [sentence_hash(text) for text in texts]
+        with self.lock:
+            new = {}
+            for (key, text) in zip(keys, texts):
+                if key not in self.rows and key not in new:
+                    new[key] = text
+            if not new:
+                return keys
+            vectors = self.encode(list(new.values()))
+            num_rows = self.num_rows
+            with open(self.vectors_path, "r+b" if num_rows else "wb") as f:
+                f.seek(num_rows * 4 * self.dim)
+                f.write(vectors.tobytes())
+                f.truncate()
+            with open(self.keys_path, "w" if not num_rows else "a") as f:
+                f.write("".join(f"{key}\n" for key in new))
+            for (row, key) in enumerate(new, start=num_rows):
+                self.rows[key] = row
+            self.num_rows = num_rows + len(new)
+            self.vectors = self.open_vectors(self.num_rows)
+        return keys
+
+    def scores(self, question, texts):
+        keys = self.add(texts)
+        rows = np.fromiter((self.rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        query = self.encode([question])[0]
+        return self.vectors[rows] @ query
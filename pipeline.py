@@ -0,0 +1,601 @@
+import asyncio
+import dataclasses
+import os
+import threading
+import time
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import cache
+import claim_table
+import compression
+import embeddings
+import papers
+import prompting
+import quantization
+import rerank
+import retrieval
+import scoring
+import segmentation
+import singleflight
+import store
+import summarizer
+import tracing
+
+
+@dataclass
+class PipelineConfig:
+    num_papers_available: int = 15
+    num_papers_shown: int = 5
+    summarization_model: str = "best sentence"
+    summarization_input: str = "best sentence"
+    concurrency: int = 8
+    timeout: float = 30
+    stream: bool = False
+    local_first: bool = False
+    # A probabilistic model (see scoring.probabilistic_models) that drops
+    # papers unlikely to answer the question before claims are ranked
+    filter_model: Optional[str] = None
+    min_yes_probability: float = 0.5
+    # Full abstracts sent to completion models are cut to about this many
+    # tokens, keeping the sentences most relevant to the question
+    max_input_tokens: Optional[int] = None
+    # Early exits; None turns each one off. latency_budget is in seconds per
+    # question. With initial_papers, only that many papers are fetched unless
+    # fewer than num_papers_shown of them have a sentence scoring at least
+    # saturation_score in the first stage. Reranking is skipped when the
+    # first-stage scores of the papers to show are at least rerank_margin
+    # apart, and reranked claims below min_claim_score are neither
+    # compressed nor shown.
+    latency_budget: Optional[float] = None
+    initial_papers: Optional[int] = None
+    saturation_score: float = 0.5
+    rerank_margin: Optional[float] = None
+    min_claim_score: Optional[float] = None
+
+
+@dataclass
+class ClaimResult:
+    short_claim: str
+    sentence: str
+    title: str
+    abstract: str
+    score: float
+
+
+@dataclass
+class PipelineResult:
+    question: str
+    claims: List[ClaimResult]
+    timings: Dict[str, float] = field(default_factory=dict)
+    spans: List[Dict] = field(default_factory=list)
+
+
+def load_cache():
+    return cache.DiskCache(
+        os.environ.get("fast_claims_cache_path", ".cache/fast_claims.sqlite"),
+        max_entries=int(os.environ.get("fast_claims_cache_max_entries", 100_000)),
+        ttl=float(os.environ["fast_claims_cache_ttl"])
+        if "fast_claims_cache_ttl" in os.environ
+        else None,
+    )
+
+
+def load_paper_store():
+    return store.PaperStore(
+        os.environ.get("fast_claims_paper_store_path", ".cache/papers.sqlite")
+    )
+
+
+def load_segmenter():
+    nlp = segmentation.load_nlp(
+        sentencizer_only=bool(os.environ.get("fast_claims_sentencizer_only"))
+    )
+    return segmentation.Segmenter(
+        nlp, n_process=int(os.environ.get("fast_claims_spacy_processes", 1))
+    )
+
+
+def load_embedding_index():
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer("msmarco-MiniLM-L-6-v3")
+    return embeddings.EmbeddingIndex(
+        model, os.environ.get("fast_claims_embeddings_path", ".cache/embeddings")
+    )
+
+
+def load_msmarco_reranker(result_cache):
+    from sentence_transformers import CrossEncoder
+
+    encoder = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-12-v2", max_length=512)
+    name = "msmarco"
+    if os.environ.get("fast_claims_quantize_msmarco"):
+        encoder = quantization.quantize(encoder)
+        name = "msmarco-int8"
+    return rerank.Reranker(encoder, name, disk_cache=result_cache)
+
+
+def load_t5_summarizer():
+    t5_summarizer = summarizer.T5Summarizer(
+        processes=int(os.environ.get("fast_claims_t5_processes", 1)),
+        quantize=bool(os.environ.get("fast_claims_quantize_t5")),
+        max_input_length=int(os.environ.get("fast_claims_t5_max_input_length", 512)),
+        batch_size=int(os.environ.get("fast_claims_t5_batch_size", 8)),
+    )
+    t5_summarizer.warm()
+    return t5_summarizer
+
+
+class Budget:
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.start = time.perf_counter()
+
+    def remaining(self):
+        if self.seconds is None:
+            return None
+        return self.seconds - (time.perf_counter() - self.start)
+
+    def spent(self, fraction=1.0):
+        # Whether more than this fraction of the budget has been used
+        if self.seconds is None:
+            return False
+        return time.perf_counter() - self.start > fraction * self.seconds
+
+
+def saturated(scored_claims, num_papers_shown, saturation_score):
+    # Whether enough papers have a sentence that looks relevant
+    scores = scored_claims.best_paper_scores()
+    return sum(1 for score in scores if score >= saturation_score) >= num_papers_shown
+
+
+def first_stage_confident(scored_claims, num_papers_shown, margin):
+    # Whether the papers to show, their order, and the first paper left out
+    # are all separated by at least margin, so reranking is unlikely to
+    # change what is shown
+    scores = scored_claims.best_paper_scores()[: num_papers_shown + 1]
+    return all(a - b >= margin for (a, b) in zip(scores, scores[1:]))
+
+
+class LazyResource:
+    # Loads a model on first use and remembers how long loading took. get()
+    # blocks if another thread (e.g. the pre-warm thread) is mid-load.
+
+    def __init__(self, load):
+        self.load = load
+        self.value = None
+        self.loaded = False
+        self.load_time = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def loaded_with(cls, value):
+        resource = cls(lambda: value)
+        resource.value = value
+        resource.loaded = True
+        return resource
+
+    def get(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    start = time.perf_counter()
+                    self.value = self.load()
+                    self.load_time = time.perf_counter() - start
+                    self.loaded = True
+        return self.value
+
+
+class ClaimPipeline:
+    # retrieve -> segment -> first-stage rank -> rerank -> compress. The stages
+    # are exposed separately so that the Streamlit app can render between
+    # them; run() executes all of them and records per-stage timings.
+    #
+    # Models are loaded on first use, so e.g. T5 is never loaded unless it
+    # is selected. prewarm() loads models in a background thread instead.
+
+    def __init__(
+        self,
+        segmenter,
+        embedding_index,
+        reranker,
+        t5_model,
+        completer,
+        result_cache=None,
+        paper_store=None,
+        tokenizer=None,
+    ):
+        self.resources = {
+            name: value if isinstance(value, LazyResource) else LazyResource.loaded_with(value)
+            for (name, value) in [
+                ("segmenter", segmenter),
+                ("embedding_index", embedding_index),
+                ("reranker", reranker),
+                ("t5_model", t5_model),
+                ("tokenizer", tokenizer),
+            ]
+        }
+        self.completer = completer
+        self.result_cache = result_cache
+        self.paper_store = paper_store
+        self.in_flight = singleflight.SingleFlight()
+        self.prompt_builder = prompting.PromptBuilder(
+            count_tokens=prompting.TokenCounter(lambda: self.tokenizer).count,
+            split=lambda text: self.segmenter.split(text),
+            relevance=lambda question, sentences: self.embedding_index.scores(question, sentences),
+        )
+
+    @classmethod
+    def from_env(cls, prewarm=()):
+        result_cache = load_cache()
+        claim_pipeline = cls(
+            segmenter=LazyResource(load_segmenter),
+            embedding_index=LazyResource(load_embedding_index),
+            reranker=LazyResource(lambda: load_msmarco_reranker(result_cache)),
+            t5_model=LazyResource(load_t5_summarizer),
+            completer=compression.Completer(
+                os.environ["openai_api_key"],
+                result_cache=result_cache,
+                batch_window=float(os.environ.get("fast_claims_batch_window_ms", 20)) / 1000,
+            ),
+            result_cache=result_cache,
+            paper_store=load_paper_store(),
+            tokenizer=LazyResource(prompting.load_tokenizer),
+        )
+        if prewarm:
+            claim_pipeline.prewarm(prewarm)
+        return claim_pipeline
+
+    @property
+    def segmenter(self):
+        return self.resources["segmenter"].get()
+
+    @property
+    def embedding_index(self):
+        return self.resources["embedding_index"].get()
+
+    @property
+    def reranker(self):
+        return self.resources["reranker"].get()
+
+    @property
+    def t5_model(self):
+        return self.resources["t5_model"].get()
+
+    @property
+    def tokenizer(self):
+        # None if token counts are estimated
+        return self.resources["tokenizer"].get()
+
+    def prewarm(self, names):
+        def load_all():
+            for name in names:
+                self.resources[name].get()
+
+        thread = threading.Thread(target=load_all, name="prewarm", daemon=True)
+        thread.start()
+        return thread
+
+    def startup_report(self):
+        # Seconds spent loading each model; None for models not loaded yet
+        return {name: resource.load_time for (name, resource) in self.resources.items()}
+
+    def shared(self, stage, key_parts, fn):
+        # Concurrent identical calls (e.g. from several users asking the same
+        # question) run fn once and share its result
+        ran = []
+
+        def run():
+            ran.append(True)
+            return fn()
+
+        result = self.in_flight.do(cache.make_key(stage, *key_parts), run)
+        span = tracing.current_span.get()
+        if span is not None:
+            span.set(shared=not ran)
+        return result
+
+    def retrieve(self, question, n, on_paper=None, local_first=False):
+        # With local_first, answer from the paper store if it has n matching
+        # papers and only search the web otherwise. Papers fetched from the
+        # web are added to the store.
+        key = cache.make_key("papers", question, n)
+        with tracing.span("retrieve") as span:
+            if self.result_cache is not None:
+                cached_papers = self.result_cache.get(key)
+                if cached_papers is not cache.missing:
+                    span.set(source="cache", papers=len(cached_papers))
+                    question_papers = [papers.Paper(**paper) for paper in cached_papers]
+                    for paper in question_papers:
+                        if on_paper is not None:
+                            on_paper(paper)
+                    return question_papers
+            notified = []
+
+            def notify(paper):
+                notified.append(paper)
+                if on_paper is not None:
+                    on_paper(paper)
+
+            (source, question_papers) = self.shared(
+                "retrieve",
+                [key, local_first],
+                lambda: self.fetch_papers(question, n, key, local_first, notify),
+            )
+            if not notified and on_paper is not None:
+                # Another caller did the fetching
+                for paper in question_papers:
+                    on_paper(paper)
+            span.set(source=source, papers=len(question_papers))
+            return question_papers
+
+    def fetch_papers(self, question, n, key, local_first, on_paper):
+        if local_first and self.paper_store is not None:
+            with tracing.span("paper_store_search"):
+                records = self.paper_store.search(question, n)
+            if len(records) >= n:
+                question_papers = [store.record_to_paper(record) for record in records]
+                for paper in question_papers:
+                    on_paper(paper)
+                return ("paper_store", question_papers)
+        records = asyncio.run(
+            retrieval.get_paper_records(
+                question,
+                n=n,
+                on_record=lambda record: on_paper(store.record_to_paper(record)),
+                known_records=self.paper_store.lookup_titles
+                if self.paper_store is not None
+                else None,
+            )
+        )
+        if self.paper_store is not None:
+            self.paper_store.add(records)
+        question_papers = [store.record_to_paper(record) for record in records]
+        if self.result_cache is not None:
+            self.result_cache.set(key, [dataclasses.asdict(paper) for paper in question_papers])
+        return ("web", question_papers)
+
+    def segment(self, question_papers):
+        with tracing.span("segment", papers=len(question_papers)) as span:
+            abstracts = [paper.abstract for paper in question_papers]
+            sentences_per_abstract = self.shared(
+                "segment", [abstracts], lambda: self.segmenter.split_many(abstracts)
+            )
+            claims = claim_table.ClaimTable(question_papers, sentences_per_abstract)
+            span.set(sentences=len(claims))
+            return claims
+
+    def first_stage_rank(self, question, claims):
+        # Returns the claims as RankedClaims, which orders them lazily
+        with tracing.span("first_stage_rank", sentences=len(claims)):
+            texts = claims.texts
+            scores = self.shared(
+                "first_stage_rank",
+                [question, texts],
+                lambda: self.embedding_index.scores(question, texts),
+            )
+            return claims.ranked(scores)
+
+    def yes_probabilities(self, question, question_papers, model):
+        # P(the abstract answers the question) for each paper, scored in bulk
+        with tracing.span("yes_probabilities", papers=len(question_papers), model=model):
+            return asyncio.run(
+                scoring.score_papers(
+                    self.completer,
+                    self.segmenter,
+                    compression.openai_url,
+                    question,
+                    question_papers,
+                    scoring.probabilistic_models[model],
+                )
+            )
+
+    def filter_answering(self, question, scored_claims, config):
+        # Drops the claims of papers whose abstract probably doesn't answer
+        # the question
+        if config.filter_model is None:
+            return scored_claims
+        question_papers = scored_claims.papers()
+        p_yes = self.yes_probabilities(question, question_papers, config.filter_model)
+        keep = {
+            paper
+            for (paper, p) in zip(question_papers, p_yes)
+            if p >= config.min_yes_probability
+        }
+        return scored_claims.where_papers(keep)
+
+    def candidates(self, scored_claims, num_papers_shown):
+        # Take the best first-stage sentences until they cover num_papers_shown papers
+        seen_papers = set()
+        top_claims = []
+        for (score, claim) in scored_claims:
+            top_claims.append(claim)
+            seen_papers.add(claim.paper)
+            if len(seen_papers) >= num_papers_shown:
+                break
+        return top_claims
+
+    def rerank(self, question, claims):
+        with tracing.span("rerank", sentences=len(claims)):
+            texts = [claim.text for claim in claims]
+            scores = self.shared(
+                "rerank", [question, texts], lambda: self.reranker.scores(question, texts)
+            )
+            order = np.argsort(-np.asarray(scores), kind="stable")
+            return [(float(scores[i]), claims[i]) for i in order]
+
+    def best_claims(self, scored_claims, limit=None):
+        # The best sentence of each paper, in ranking order
+        best = []
+        seen_papers = set()
+        for (score, claim) in scored_claims:
+            if claim.paper in seen_papers:
+                continue
+            best.append((score, claim))
+            seen_papers.add(claim.paper)
+            if len(best) == limit:
+                break
+        return best
+
+    async def compress(self, question, claims, config, on_partial=None, on_timeout=None):
+        # Yields (index, short_claim) pairs in completion order. With
+        # config.stream, on_partial(index, text) receives partial completions.
+        # Claims not compressed within config.timeout get on_timeout(claim)
+        # (see compression.compress_claims).
+        compressor = compression.make_compressor(
+            config.summarization_model,
+            config.summarization_input,
+            self.completer,
+            self.segmenter,
+            prompt_builder=self.prompt_builder,
+            max_input_tokens=config.max_input_tokens,
+        )
+        results = asyncio.Queue()
+        done = object()
+
+        async def produce():
+            # Runs in its own task so that the span is opened and closed in
+            # one context, not held open across this generator's yields
+            try:
+                with tracing.span(
+                    "compress", model=config.summarization_model, claims=len(claims)
+                ):
+                    if compressor is None:
+                        short_claims = await self.t5_compress(claims, config, on_timeout)
+                        for result in enumerate(short_claims):
+                            results.put_nowait(result)
+                        return
+                    async for result in compression.compress_claims(
+                        claims,
+                        question,
+                        compressor,
+                        concurrency=config.concurrency,
+                        timeout=config.timeout,
+                        on_partial=on_partial if config.stream else None,
+                        on_timeout=on_timeout,
+                    ):
+                        results.put_nowait(result)
+            finally:
+                results.put_nowait(done)
+
+        task = asyncio.ensure_future(produce())
+        try:
+            while True:
+                result = await results.get()
+                if result is done:
+                    break
+                yield result
+            await task
+        finally:
+            task.cancel()
+
+    async def t5_compress(self, claims, config, on_timeout=None):
+        t5_model = self.t5_model
+        texts = [compression.input_text(claim, config.summarization_input) for claim in claims]
+        with tracing.span("t5_generate", batch=len(claims)) as span:
+            try:
+                return await asyncio.wait_for(t5_model.summarize(texts), config.timeout)
+            except asyncio.TimeoutError:
+                span.set(timed_out=True)
+                return [compression.timeout_result(claim, on_timeout) for claim in claims]
+
+    async def compress_all(self, question, claims, config, on_timeout=None):
+        short_claims = [None] * len(claims)
+        async for (i, short_claim) in self.compress(
+            question, claims, config, on_timeout=on_timeout
+        ):
+            short_claims[i] = short_claim
+        return short_claims
+
+    def retrieve_adaptively(self, question, config, budget, on_paper=None):
+        # With config.initial_papers, fetch that many papers first and the
+        # rest only if they don't already give enough relevant sentences
+        n = config.num_papers_available
+        if config.initial_papers is None or config.initial_papers >= n:
+            return self.retrieve(question, n, on_paper, config.local_first)
+        question_papers = self.retrieve(
+            question, config.initial_papers, on_paper, config.local_first
+        )
+        scored_claims = self.first_stage_rank(question, self.segment(question_papers))
+        if budget.spent(0.5) or saturated(
+            scored_claims, config.num_papers_shown, config.saturation_score
+        ):
+            return question_papers
+        seen = set(question_papers)
+
+        def on_new_paper(paper):
+            if paper not in seen and on_paper is not None:
+                on_paper(paper)
+
+        with tracing.span("expand_papers", initial=len(question_papers)):
+            return self.retrieve(question, n, on_new_paper, config.local_first)
+
+    def select_claims(self, question, scored_claims, config, budget):
+        # The best (score, claim) of each paper to show, reranking only when
+        # the first stage isn't confident and there is time left
+        n = config.num_papers_shown
+        skip_reason = None
+        if budget.spent():
+            skip_reason = "latency_budget"
+        elif config.rerank_margin is not None and first_stage_confident(
+            scored_claims, n, config.rerank_margin
+        ):
+            skip_reason = "confident"
+        if skip_reason is not None:
+            with tracing.span("rerank", skipped=skip_reason):
+                return self.best_claims(scored_claims, limit=n)
+        best = self.best_claims(self.rerank(question, self.candidates(scored_claims, n)))
+        if config.min_claim_score is not None:
+            best = [(score, claim) for (score, claim) in best if score >= config.min_claim_score]
+        return best
+
+    async def compress_within_budget(self, question, claims, config, budget):
+        # Claims whose compression would overrun the budget are shown as
+        # their best sentence
+        remaining = budget.remaining()
+        if remaining is None:
+            return await self.compress_all(question, claims, config)
+        if remaining <= 0:
+            return [claim.text for claim in claims]
+        return await self.compress_all(
+            question,
+            claims,
+            dataclasses.replace(config, timeout=min(config.timeout, remaining)),
+            on_timeout=lambda claim: claim.text,
+        )
+
+    def run(self, question, config=None, question_papers=None):
+        config = config or PipelineConfig()
+        budget = Budget(config.latency_budget)
+        with tracing.trace("pipeline", question=question) as trace:
+            if question_papers is None:
+                question_papers = self.retrieve_adaptively(question, config, budget)
+            claims = self.segment(question_papers)
+            scored_claims = self.first_stage_rank(question, claims)
+            scored_claims = self.filter_answering(question, scored_claims, config)
+            best = self.select_claims(question, scored_claims, config, budget)
+            short_claims = asyncio.run(
+                self.compress_within_budget(
+                    question, [claim for (score, claim) in best], config, budget
+                )
+            )
+        results = [
+            ClaimResult(
+                short_claim=short_claim,
+                sentence=claim.text,
+                title=claim.paper.title,
+                abstract=claim.paper.abstract,
+                score=float(score),
+            )
+            for ((score, claim), short_claim) in zip(best, short_claims)
+        ]
+        return PipelineResult(
+            question=question,
+            claims=results,
+            timings=trace.stage_timings(),
+            spans=trace.to_dicts(),
+        )
@@ -0,0 +1,125 @@
+import string
+import threading
+
+import batching
+import prompts
+import tracing
+
+
+def load_tokenizer():
+    # GPT-3 models use the GPT-2 byte-pair encoding. If the tokenizer can't
+    # be loaded (e.g. offline without cached files, where transformers raises
+    # ValueError or OSError depending on the version) token counts are
+    # estimated instead.
+    try:
+        from transformers import GPT2TokenizerFast
+
+        return GPT2TokenizerFast.from_pretrained("gpt2")
+    except Exception:
+        return None
+
+
+class TokenCounter:
+    # Counts tokens with the tokenizer returned by load (loaded on first use),
+    # or estimates them from the text length if there is no tokenizer
+
+    def __init__(self, load=None):
+        self.load = load
+        self.tokenizer = None
+        self.loaded = load is None
+        self.lock = threading.Lock()
+
+    def count(self, text):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.tokenizer = self.load()
+                    self.loaded = True
+        if self.tokenizer is None:
+            return batching.estimated_tokens(text, 0)
+        return len(self.tokenizer.encode(text))
+
+
+class Template:
+    # A prompt template whose static text is tokenized once
+
+    def __init__(self, name, text, count_tokens):
+        self.name = name
+        self.text = text
+        parts = list(string.Formatter().parse(text))
+        self.fields = [field for (literal, field, spec, conversion) in parts if field]
+        self.static_tokens = count_tokens("".join(literal for (literal, *rest) in parts))
+
+    def format(self, **fields):
+        return self.text.format(**fields)
+
+
+class PromptBuilder:
+    # Builds prompts from the templates in prompts.py and keeps count of the
+    # tokens they cost. Field tokens are counted per call; the static
+    # few-shot text is only counted once per template.
+    #
+    # input_text cuts full abstracts longer than max_tokens down to the
+    # sentences most relevant to the question (by relevance(question,
+    # sentences), or the first ones without it), always keeping the claim's
+    # own sentence and the original sentence order.
+
+    def __init__(self, count_tokens=None, split=None, relevance=None):
+        self.count_tokens = count_tokens or TokenCounter().count
+        self.split = split
+        self.relevance = relevance
+        self.templates = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def template(self, name):
+        with self.lock:
+            template = self.templates.get(name)
+        if template is None:
+            template = Template(name, getattr(prompts, name), self.count_tokens)
+            with self.lock:
+                self.templates.setdefault(name, template)
+        return template
+
+    def input_text(self, claim, input_type, question, max_tokens=None):
+        if input_type == "best sentence":
+            return claim.text
+        abstract = claim.paper.abstract
+        if max_tokens is None or self.split is None:
+            return abstract
+        if self.count_tokens(abstract) <= max_tokens:
+            return abstract
+        sentences = self.split(abstract)
+        if self.relevance is not None:
+            scores = self.relevance(question, sentences)
+            order = sorted(range(len(sentences)), key=lambda i: -scores[i])
+        else:
+            order = list(range(len(sentences)))
+        order.sort(key=lambda i: sentences[i] != claim.text)
+        kept, tokens = set(), 0
+        for i in order:
+            sentence_tokens = self.count_tokens(sentences[i]) + 1
+            if kept and tokens + sentence_tokens > max_tokens:
+                continue
+            kept.add(i)
+            tokens += sentence_tokens
+        return " ".join(sentences[i].strip() for i in sorted(kept))
+
+    def build(self, name, **fields):
+        template = self.template(name)
+        prompt = template.format(**fields)
+        field_tokens = sum(self.count_tokens(str(fields[field])) for field in template.fields)
+        prompt_tokens = template.static_tokens + field_tokens
+        span = tracing.current_span.get()
+        if span is not None:
+            span.set(prompt_template=name, prompt_tokens=prompt_tokens)
+        with self.lock:
+            totals = self.totals.setdefault(name, {"prompts": 0, "tokens": 0})
+            totals["prompts"] += 1
+            totals["tokens"] += prompt_tokens
+        return prompt
+
+    def stats(self):
+        # Prompts built and their (counted) tokens, per template
+        with self.lock:
+            return {name: dict(totals) for (name, totals) in self.totals.items()}
@@ -0,0 +1,9 @@
+def quantize(wrapper):
+    # Dynamic int8 quantization of the linear layers of wrapper.model (a
+    # CrossEncoder or SimpleT5), which dominate CPU inference time
+    import torch
+
+    wrapper.model = torch.quantization.quantize_dynamic(
+        wrapper.model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return wrapper
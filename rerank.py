@@ -0,0 +1,103 @@
+import collections
+import threading
+
+import cache
+import tracing
+
+
+class Reranker:
+    # Scores (question, sentence) pairs with a CrossEncoder. Pairs are sorted
+    # by token length and cut into batches of similar length so little time is
+    # spent on padding; each batch holds roughly tokens_per_batch tokens, so
+    # short sentences get large batches and long ones small batches. Scores are
+    # memoized in an in-process LRU and, if given, in a DiskCache.
+
+    def __init__(
+        self,
+        encoder,
+        name,
+        disk_cache=None,
+        memo_size=50_000,
+        tokens_per_batch=4096,
+        max_length=512,
+    ):
+        self.encoder = encoder
+        self.name = name
+        self.disk_cache = disk_cache
+        self.memo = collections.OrderedDict()
+        self.memo_size = memo_size
+        self.tokens_per_batch = tokens_per_batch
+        self.max_length = max_length
+        self.lock = threading.Lock()
+
+    def memo_get(self, key):
+        with self.lock:
+            score = self.memo.get(key)
+            if score is not None:
+                self.memo.move_to_end(key)
+        return score
+
+    def memo_set(self, key, score):
+        with self.lock:
+            self.memo[key] = score
+            self.memo.move_to_end(key)
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def lookup(self, key):
+        score = self.memo_get(key)
+        if score is None and self.disk_cache is not None:
+            score = self.disk_cache.get(key, None)
+            if score is not None:
+                self.memo_set(key, score)
+        return score
+
+    def pair_lengths(self, question, texts):
+        encoded = self.encoder.tokenizer(
+            [question] * len(texts),
+            texts,
+            truncation=True,
+            max_length=self.max_length,
+        )
+        return [len(input_ids) for input_ids in encoded["input_ids"]]
+
+    def batches(self, question, texts):
+        lengths = self.pair_lengths(question, texts)
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        batch = []
+        for i in order:
+            # Sorted ascending, so the current pair is the longest in its batch
+            if batch and (len(batch) + 1) * lengths[i] > self.tokens_per_batch:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def predict(self, question, texts):
+        scores = [None] * len(texts)
+        for batch in self.batches(question, texts):
+            batch_scores = self.encoder.predict(
+                [(question, texts[i]) for i in batch],
+                batch_size=len(batch),
+                show_progress_bar=False,
+            )
+            for (i, score) in zip(batch, batch_scores):
+                scores[i] = float(score)
+        return scores
+
+    def scores(self, question, texts):
+        keys = [cache.make_key(self.name, question, text) for text in texts]
+        scores = [self.lookup(key) for key in keys]
+        uncached = [i for (i, score) in enumerate(scores) if score is None]
+        if uncached:
+            with tracing.span(
+                "crossencoder", pairs=len(uncached), cached=len(texts) - len(uncached)
+            ):
+                new_scores = self.predict(question, [texts[i] for i in uncached])
+            for (i, score) in zip(uncached, new_scores):
+                scores[i] = score
+                self.memo_set(keys[i], score)
+                if self.disk_cache is not None:
+                    self.disk_cache.set(keys[i], score)
+        return scores
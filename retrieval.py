@@ -0,0 +1,247 @@
+import asyncio
+import os
+import re
+
+from urllib.parse import unquote, urlparse
+
+import aiohttp
+
+import tracing
+
+
+semantic_scholar_url = os.environ.get(
+    "semantic_scholar_url", "https://api.semanticscholar.org/graph/v1"
+)
+serpapi_url = os.environ.get("serpapi_url", "https://serpapi.com")
+paper_fields = "title,abstract,venue,authors,citationCount,url,year"
+# Seconds per Semantic Scholar request, and the longest we wait before a retry
+# however long Retry-After asks us to
+request_timeout = 20.0
+max_retry_delay = 10.0
+
+
+# Patterns for the paper IDs Semantic Scholar accepts (as DOI:, ARXIV:, PMID:
+# and PMCID:) in the links of Google Scholar results, and the sites whose
+# links it resolves itself (as URL:)
+doi_pattern = re.compile(r"\b(10\.\d{4,9}/[^\s?#]+)")
+arxiv_pattern = re.compile(r"arxiv\.org/(?:abs|pdf)/([^\s?#]+?)(?:v\d+)?(?:\.pdf)?/?$")
+pubmed_pattern = re.compile(r"pubmed\.ncbi\.nlm\.nih\.gov/(\d+)")
+pmc_pattern = re.compile(r"ncbi\.nlm\.nih\.gov/pmc/articles/PMC(\d+)")
+url_id_hosts = ["semanticscholar.org", "aclweb.org", "acm.org", "biorxiv.org"]
+
+
+def semantic_scholar_headers():
+    return {"x-api-key": os.environ["semantic_scholar_api_key"]}
+
+
+def retry_delay(response, attempt, backoff):
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), max_retry_delay)
+        except ValueError:
+            pass
+    return min(backoff * 2 ** attempt, max_retry_delay)
+
+
+async def get_json(
+    session, semaphore, url, params=None, max_retries=3, backoff=1.0, post_json=None
+):
+    # GETs url, or POSTs post_json to it. Retries rate-limited (429) and
+    # server-side (5xx) failures, connection errors and timeouts with
+    # exponential backoff, honoring Retry-After (up to max_retry_delay) when
+    # Semantic Scholar sends it. Returns {} if every attempt fails.
+    method = "GET" if post_json is None else "POST"
+    with tracing.span("semantic_scholar", url=url) as span:
+        for attempt in range(max_retries + 1):
+            span.set(attempts=attempt + 1)
+            try:
+                async with semaphore:
+                    async with session.request(
+                        method, url, params=params, json=post_json
+                    ) as response:
+                        span.set(status=response.status)
+                        if response.status != 429 and response.status < 500:
+                            return await response.json(content_type=None)
+                        delay = retry_delay(response, attempt, backoff)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                span.set(error=repr(e))
+                delay = retry_delay(None, attempt, backoff)
+            if attempt < max_retries:
+                await asyncio.sleep(delay)
+        return {}
+
+
+async def search_scholar(question, n):
+    import serpapi
+
+    params = {
+        "engine": "google_scholar",
+        "q": question,
+        "api_key": os.environ["serpapi_api_key"],
+        "num": min(n * 2, 20),
+    }
+    search = serpapi.GoogleSearch(params)
+    search.BACKEND = serpapi_url
+    loop = asyncio.get_running_loop()
+    with tracing.span("serpapi") as span:
+        data = await loop.run_in_executor(None, search.get_dict)
+        span.set(results=len(data.get("organic_results", [])))
+    return data.get("organic_results", [])
+
+
+def external_id(link):
+    # The Semantic Scholar ID of the paper a Google Scholar result links to,
+    # or None if the link doesn't name one
+    if not link:
+        return None
+    match = arxiv_pattern.search(link)
+    if match:
+        return f"ARXIV:{match.group(1)}"
+    match = doi_pattern.search(link)
+    if match:
+        return f"DOI:{unquote(match.group(1))}"
+    match = pubmed_pattern.search(link)
+    if match:
+        return f"PMID:{match.group(1)}"
+    match = pmc_pattern.search(link)
+    if match:
+        return f"PMCID:{match.group(1)}"
+    host = urlparse(link).netloc
+    if any(host == site or host.endswith("." + site) for site in url_id_hosts):
+        return f"URL:{link}"
+    return None
+
+
+async def lookup_papers_by_id(session, semaphore, paper_ids, max_retries=3):
+    # Returns the Semantic Scholar records of the papers with the given IDs
+    # (see external_id) that have an abstract, by ID, from one /paper/batch
+    # request
+    response_json = await get_json(
+        session,
+        semaphore,
+        f"{semantic_scholar_url}/paper/batch",
+        params={"fields": paper_fields},
+        max_retries=max_retries,
+        post_json={"ids": paper_ids},
+    )
+    # The batch endpoint answers with a list in the order of the IDs, with
+    # null for unknown IDs
+    if not isinstance(response_json, list):
+        return {}
+    return {
+        paper_id: record
+        for (paper_id, record) in zip(paper_ids, response_json)
+        if record and record.get("abstract")
+    }
+
+
+async def lookup_paper(session, semaphore, title, max_retries=3):
+    # Returns the Semantic Scholar record (paper_fields plus paperId) of the
+    # best match for title, or None if there is none or it has no abstract.
+    # The search endpoint returns the fields directly, so no separate detail
+    # request is needed.
+    response_json = await get_json(
+        session,
+        semaphore,
+        f"{semantic_scholar_url}/paper/search",
+        params={"query": title, "limit": 1, "fields": paper_fields},
+        max_retries=max_retries,
+    )
+    datum = response_json.get("data")
+    if not datum or not datum[0].get("abstract"):
+        return None
+    record = datum[0]
+    record["title"] = record.get("title") or title
+    record["scholarTitle"] = title
+    return record
+
+
+async def get_paper_records(
+    question, n=10, concurrency=8, max_retries=3, on_record=None, known_records=None
+):
+    # Returns up to n records in Google Scholar order. on_record(record) is
+    # called for each of them, in that order, as soon as it and the lookups
+    # of all titles before it have finished, so only records that end up in
+    # the result are reported; once n are, the remaining lookups are
+    # cancelled. known_records maps Scholar titles to records we already
+    # have, which are not looked up again. Results whose link names a paper
+    # ID are looked up together in one batch request, the others (and IDs
+    # the batch doesn't resolve) by title.
+    scholar_results = await search_scholar(question, n)
+    hits = [
+        (result["title"], external_id(result.get("link")))
+        for result in scholar_results
+        if result.get("title")
+    ]
+    titles = [title for (title, paper_id) in hits]
+    known = known_records(titles) if known_records is not None else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers=semantic_scholar_headers(),
+        timeout=aiohttp.ClientTimeout(total=request_timeout),
+    ) as session:
+
+        pending = object()
+        results = [pending] * len(hits)
+        records = []
+        resolved = 0
+        tasks = []
+
+        def report_ready():
+            # Report the records whose lookups, and those of every title
+            # before them, are done
+            nonlocal resolved
+            while resolved < len(hits) and results[resolved] is not pending:
+                record = results[resolved]
+                resolved += 1
+                if record is not None and len(records) < n:
+                    records.append(record)
+                    if on_record is not None:
+                        on_record(record)
+                    if len(records) == n:
+                        for task in tasks:
+                            if task is not asyncio.current_task():
+                                task.cancel()
+
+        paper_ids = [
+            paper_id for (title, paper_id) in hits if paper_id and title not in known
+        ]
+        by_id = None
+        if paper_ids:
+            by_id = asyncio.ensure_future(
+                lookup_papers_by_id(session, semaphore, paper_ids, max_retries)
+            )
+
+        async def lookup(i, title, paper_id):
+            record = known.get(title)
+            if record is None and paper_id and by_id is not None:
+                # Shielded: one cancelled lookup must not cancel the batch
+                record = (await asyncio.shield(by_id)).get(paper_id)
+                if record is not None:
+                    record["title"] = record.get("title") or title
+                    record["scholarTitle"] = title
+            if record is None:
+                record = await lookup_paper(session, semaphore, title, max_retries)
+            results[i] = record
+            report_ready()
+
+        # Look up all titles at once; records are reported in Google Scholar order
+        tasks.extend(
+            asyncio.ensure_future(lookup(i, title, paper_id))
+            for (i, (title, paper_id)) in enumerate(hits)
+        )
+        try:
+            if tasks:
+                await asyncio.wait(tasks)
+            for task in tasks:
+                if not task.cancelled():
+                    task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if by_id is not None:
+                by_id.cancel()
+    return records
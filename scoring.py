@@ -0,0 +1,91 @@
+import asyncio
+
+import aiohttp
+import numpy as np
+
+import prompts
+
+
+probabilistic_models = {
+    "probabilistic-davinci-v2": "davinci:ft-ought-1-2021-10-29-06-01-26",
+    "probabilistic-curie-v2": "curie:ft-ought-1-2021-10-29-05-04-11",
+}
+
+answers = ["Yes", "No", "Not"]
+
+# With only the top token per position we rarely see more than one of the
+# answers; five is the most the completions API returns
+top_logprobs = 5
+
+
+def lines_to_enum_string(lines):
+    return "\n".join([f"{i+1}. {line.strip()}" for (i, line) in enumerate(lines)]).strip()
+
+
+def probabilistic_prompt(segmenter, question, paper):
+    return prompts.probabilistic_qa_prompt.format(
+        question=question,
+        title=paper.title,
+        abstract_lines=lines_to_enum_string(segmenter.split(paper.abstract)),
+    )
+
+
+def answer_logprobs(logprobs):
+    # Log-probabilities of Yes/No/Not at the first token position that offers
+    # any of them, parsed in one pass; -inf for answers not among the top
+    # tokens there
+    row = np.full(len(answers), -np.inf)
+    for position in (logprobs or {}).get("top_logprobs") or []:
+        found = False
+        for (token, logprob) in (position or {}).items():
+            token = token.strip()
+            if token in answers:
+                j = answers.index(token)
+                row[j] = np.logaddexp(row[j], logprob)
+                found = True
+        if found:
+            break
+    return row
+
+
+def probabilities_of_yes(logprobs_list):
+    # P(the abstract answers the question) for each completion's logprobs,
+    # with "not sure" counting half. Probabilities are renormalized over the
+    # three answers; completions with none of them get 0.
+    if not logprobs_list:
+        return np.zeros(0)
+    probs = np.exp(np.stack([answer_logprobs(logprobs) for logprobs in logprobs_list]))
+    (p_yes, p_no, p_not) = probs.T
+    total = probs.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = (p_yes + 0.5 * p_not) / total
+    return np.where(total > 0, p, 0.0)
+
+
+def probability_of_yes(logprobs):
+    return float(probabilities_of_yes([logprobs])[0])
+
+
+async def score_papers(completer, segmenter, openai_url, question, question_papers, model, concurrency=8):
+    # P(yes) for every paper in one go: the completions only need the answer
+    # token, so they are cheap and (with a batching Completer) share requests
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as session:
+
+        async def answer(paper):
+            data = {
+                "model": model,
+                "prompt": probabilistic_prompt(segmenter, question, paper),
+                "max_tokens": 1,
+                "temperature": 0,
+                "logprobs": top_logprobs,
+            }
+            async with semaphore:
+                completion_result = await completer.complete(
+                    session, f"{openai_url}/completions", data
+                )
+            choices = completion_result.get("choices")
+            return choices[0].get("logprobs") if choices else None
+
+        logprobs_list = await asyncio.gather(*[answer(paper) for paper in question_papers])
+    return probabilities_of_yes(logprobs_list)
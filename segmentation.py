@@ -0,0 +1,59 @@
+import collections
+import threading
+
+
+def load_nlp(sentencizer_only=False):
+    # Sentence boundaries come from the dependency parser, so the tagger and
+    # NER are never needed. The rule-based sentencizer is much faster still,
+    # but splits some abstracts differently.
+    import spacy
+
+    if sentencizer_only:
+        nlp = spacy.load("en_core_web_sm", disable=["tagger", "parser", "ner"])
+        nlp.add_pipe(nlp.create_pipe("sentencizer"))
+        return nlp
+    return spacy.load("en_core_web_sm", disable=["tagger", "ner"])
+
+
+class Segmenter:
+    # Splits texts into sentences, segmenting each distinct text once per
+    # process. split_many runs all uncached texts through one nlp.pipe call.
+
+    def __init__(self, nlp, n_process=1, batch_size=32, memo_size=10_000):
+        self.nlp = nlp
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.memo = collections.OrderedDict()
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+
+    def remember(self, text, sentences):
+        with self.lock:
+            self.memo[text] = sentences
+            self.memo.move_to_end(text)
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+
+    def cached(self, text):
+        with self.lock:
+            sentences = self.memo.get(text)
+            if sentences is not None:
+                self.memo.move_to_end(text)
+        return sentences
+
+    def split_many(self, texts):
+        results = [self.cached(text) for text in texts]
+        uncached = list(dict.fromkeys(t for (t, r) in zip(texts, results) if r is None))
+        if uncached:
+            docs = self.nlp.pipe(
+                uncached,
+                n_process=self.n_process if len(uncached) > 1 else 1,
+                batch_size=self.batch_size,
+            )
+            for (text, doc) in zip(uncached, docs):
+                self.remember(text, [sent.text for sent in doc.sents])
+            results = [self.cached(text) or [] for text in texts]
+        return results
+
+    def split(self, text):
+        return self.split_many([text])[0]
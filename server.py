@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import typing
+
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import cache
+import compression
+import pipeline
+import scoring
+
+
+config_types = typing.get_type_hints(pipeline.PipelineConfig)
+
+
+def parse_value(name, value):
+    # Checks a JSON value against the type of config field `name`. Optional
+    # fields accept null, and float fields accept integers.
+    field_type = config_types[name]
+    if typing.get_origin(field_type) is typing.Union:
+        if value is None:
+            return None
+        (field_type,) = [t for t in typing.get_args(field_type) if t is not type(None)]
+    if field_type is float and type(value) is int:
+        return float(value)
+    # Not isinstance, which would let true pass for an int
+    if type(value) is not field_type:
+        raise TypeError(f"{name} must be of type {field_type.__name__}, not {value!r}")
+    return value
+
+
+def parse_config(body):
+    config = pipeline.PipelineConfig(
+        **{
+            key: parse_value(key, value)
+            for (key, value) in body.items()
+            if key in config_types
+        }
+    )
+    if config.summarization_model not in compression.summarization_models:
+        raise ValueError(f"Unknown summarization_model {config.summarization_model!r}")
+    if config.summarization_input not in compression.summarization_inputs:
+        raise ValueError(f"Unknown summarization_input {config.summarization_input!r}")
+    if config.filter_model is not None and config.filter_model not in scoring.probabilistic_models:
+        raise ValueError(f"Unknown filter_model {config.filter_model!r}")
+    return config
+
+
+class ClaimServer:
+    # Serves the pipeline to many clients (e.g. several Streamlit sessions)
+    # from one process: models are loaded once, questions run on a pool of
+    # worker threads, and identical requests that arrive while one is being
+    # answered wait for that answer instead of running the pipeline again.
+    # Below the request level, ClaimPipeline shares identical in-flight work
+    # stage by stage, so overlapping questions also share paper fetches and
+    # model calls.
+
+    def __init__(self, claim_pipeline, workers=None):
+        self.claim_pipeline = claim_pipeline
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.in_flight = {}
+        self.requests = 0
+        self.shared_requests = 0
+
+    def app(self):
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/claims", self.claims),
+                web.get("/healthz", self.healthz),
+                web.get("/stats", self.stats),
+            ]
+        )
+        app.on_cleanup.append(self.shutdown)
+        return app
+
+    async def claims(self, request):
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Request body must be a JSON object")
+        question = body.get("question")
+        if not question:
+            raise web.HTTPBadRequest(text="Missing question")
+        try:
+            config = parse_config(body)
+        except (TypeError, ValueError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        self.requests += 1
+        key = cache.make_key(question, dataclasses.asdict(config))
+        task = self.in_flight.get(key)
+        if task is None:
+            loop = asyncio.get_running_loop()
+            task = self.in_flight[key] = asyncio.ensure_future(
+                loop.run_in_executor(self.executor, self.claim_pipeline.run, question, config)
+            )
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.shared_requests += 1
+        # A client disconnecting must not cancel the answer for the others
+        result = await asyncio.shield(task)
+        return web.json_response(dataclasses.asdict(result))
+
+    async def healthz(self, request):
+        return web.json_response({"ok": True})
+
+    async def stats(self, request):
+        claim_pipeline = self.claim_pipeline
+        batcher = claim_pipeline.completer.batcher
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "shared_requests": self.shared_requests,
+                "requests_in_flight": len(self.in_flight),
+                "stage_calls_in_flight": claim_pipeline.in_flight.in_flight(),
+                "shared_stage_calls": claim_pipeline.in_flight.shared,
+                "completion_requests_sent": batcher.requests_sent if batcher else None,
+                "cache": claim_pipeline.result_cache.stats()
+                if claim_pipeline.result_cache is not None
+                else None,
+                "model_load_seconds": claim_pipeline.startup_report(),
+                "prompt_tokens": claim_pipeline.prompt_builder.stats(),
+            }
+        )
+
+    async def shutdown(self, app):
+        self.executor.shutdown(wait=False)
+        t5_summarizer = self.claim_pipeline.resources["t5_model"]
+        if t5_summarizer.loaded:
+            t5_summarizer.value.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve claim extraction over HTTP to several clients."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Questions answered in parallel (default: number of cores)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    claim_pipeline = pipeline.ClaimPipeline.from_env(
+        prewarm=["segmenter", "embedding_index", "reranker", "tokenizer"]
+    )
+    server = ClaimServer(claim_pipeline, workers=args.workers)
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
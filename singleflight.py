@@ -0,0 +1,47 @@
+import threading
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Runs at most one fn per key at a time. Threads that ask for a key that is
+    # already being computed wait for that computation and share its result
+    # (or exception) instead of repeating the work.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,224 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import papers
+
+
+stopwords = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "how", "i", "in", "is", "it", "of", "on", "or", "that", "the", "to",
+    "we", "what", "when", "which", "who", "why", "with",
+}
+
+
+def query_terms(question):
+    terms = [term for term in re.findall(r"\w+", question.lower()) if term not in stopwords]
+    return list(dict.fromkeys(terms))
+
+
+def title_key(title):
+    return " ".join(re.findall(r"\w+", title.lower()))
+
+
+def record_to_paper(record):
+    return papers.Paper(title=record["title"], abstract=record["abstract"])
+
+
+class PaperStore:
+    # Papers we have fetched from Semantic Scholar, keyed by paperId, with a
+    # full-text (FTS5) index over title and abstract
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS papers (
+                    rowid INTEGER PRIMARY KEY,
+                    paper_id TEXT UNIQUE NOT NULL,
+                    title TEXT NOT NULL,
+                    abstract TEXT NOT NULL,
+                    venue TEXT,
+                    authors TEXT,
+                    citation_count INTEGER,
+                    year INTEGER,
+                    url TEXT,
+                    ingested_at REAL NOT NULL
+                )
+                """
+            )
+            self.connection.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS papers_fts USING fts5(
+                    title, abstract, content='papers', content_rowid='rowid'
+                )
+                """
+            )
+            # Titles (e.g. from Google Scholar) known to resolve to a paper
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS titles (
+                    title_key TEXT PRIMARY KEY,
+                    paper_id TEXT NOT NULL
+                )
+                """
+            )
+            self.connection.executescript(
+                """
+                CREATE TRIGGER IF NOT EXISTS papers_insert AFTER INSERT ON papers BEGIN
+                    INSERT INTO papers_fts(rowid, title, abstract)
+                    VALUES (new.rowid, new.title, new.abstract);
+                END;
+                CREATE TRIGGER IF NOT EXISTS papers_delete AFTER DELETE ON papers BEGIN
+                    INSERT INTO papers_fts(papers_fts, rowid, title, abstract)
+                    VALUES ('delete', old.rowid, old.title, old.abstract);
+                END;
+                CREATE TRIGGER IF NOT EXISTS papers_update AFTER UPDATE ON papers BEGIN
+                    INSERT INTO papers_fts(papers_fts, rowid, title, abstract)
+                    VALUES ('delete', old.rowid, old.title, old.abstract);
+                    INSERT INTO papers_fts(rowid, title, abstract)
+                    VALUES (new.rowid, new.title, new.abstract);
+                END;
+                """
+            )
+
+    def __len__(self):
+        with self.lock:
+            (count,) = self.connection.execute("SELECT COUNT(*) FROM papers").fetchone()
+        return count
+
+    def add(self, records):
+        # Inserts or refreshes Semantic Scholar paper records; records without
+        # a paperId or abstract are skipped. Each record's title and, if set,
+        # its scholarTitle are remembered for lookup_titles.
+        now = time.time()
+        rows = [
+            (
+                record["paperId"],
+                record["title"],
+                record["abstract"],
+                record.get("venue"),
+                json.dumps(record.get("authors") or []),
+                record.get("citationCount"),
+                record.get("year"),
+                record.get("url"),
+                now,
+            )
+            for record in records
+            if record.get("paperId") and record.get("abstract") and record.get("title")
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                """
+                INSERT INTO papers
+                    (paper_id, title, abstract, venue, authors, citation_count, year, url, ingested_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(paper_id) DO UPDATE SET
+                    title = excluded.title,
+                    abstract = excluded.abstract,
+                    venue = excluded.venue,
+                    authors = excluded.authors,
+                    citation_count = excluded.citation_count,
+                    year = excluded.year,
+                    url = excluded.url,
+                    ingested_at = excluded.ingested_at
+                """,
+                rows,
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO titles VALUES (?, ?)",
+                [
+                    (title_key(title), record["paperId"])
+                    for record in records
+                    if record.get("paperId") and record.get("abstract") and record.get("title")
+                    for title in {record["title"], record.get("scholarTitle") or record["title"]}
+                ],
+            )
+        return len(rows)
+
+    def lookup_titles(self, titles):
+        # Returns {title: record} for the titles we have resolved before
+        keys = {title: title_key(title) for title in titles}
+        distinct_keys = list(set(keys.values()))
+        if not distinct_keys:
+            return {}
+        placeholders = ", ".join("?" for _ in distinct_keys)
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT title_key, paper_id FROM titles WHERE title_key IN ({placeholders})",
+                distinct_keys,
+            ).fetchall()
+        paper_ids = dict(rows)
+        records = self.get(set(paper_ids.values()))
+        return {
+            title: records[paper_ids[key]]
+            for (title, key) in keys.items()
+            if key in paper_ids and paper_ids[key] in records
+        }
+
+    def row_to_record(self, row):
+        (paper_id, title, abstract, venue, authors, citation_count, year, url) = row
+        return {
+            "paperId": paper_id,
+            "title": title,
+            "abstract": abstract,
+            "venue": venue,
+            "authors": json.loads(authors) if authors else [],
+            "citationCount": citation_count,
+            "year": year,
+            "url": url,
+        }
+
+    def get(self, paper_ids):
+        # Returns {paperId: record} for the ids that are stored
+        paper_ids = list(paper_ids)
+        if not paper_ids:
+            return {}
+        placeholders = ", ".join("?" for _ in paper_ids)
+        with self.lock:
+            rows = self.connection.execute(
+                f"""
+                SELECT paper_id, title, abstract, venue, authors, citation_count, year, url
+                FROM papers WHERE paper_id IN ({placeholders})
+                """,
+                paper_ids,
+            ).fetchall()
+        return {row[0]: self.row_to_record(row) for row in rows}
+
+    def search(self, question, n=10, min_term_fraction=0.5):
+        # BM25-ranked full-text search. A paper only counts as a hit if it
+        # contains at least min_term_fraction of the question's content words.
+        terms = query_terms(question)
+        if not terms:
+            return []
+        match = " OR ".join(f'"{term}"' for term in terms)
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                SELECT papers.paper_id, papers.title, papers.abstract, papers.venue,
+                       papers.authors, papers.citation_count, papers.year, papers.url
+                FROM papers_fts JOIN papers ON papers.rowid = papers_fts.rowid
+                WHERE papers_fts MATCH ?
+                ORDER BY bm25(papers_fts)
+                LIMIT ?
+                """,
+                (match, n * 5),
+            ).fetchall()
+        records = []
+        for row in rows:
+            text = f"{row[1]} {row[2]}".lower()
+            matched = sum(1 for term in terms if re.search(rf"\b{re.escape(term)}\b", text))
+            if matched >= min_term_fraction * len(terms):
+                records.append(self.row_to_record(row))
+            if len(records) >= n:
+                break
+        return records
@@ -0,0 +1,108 @@
+import asyncio
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import quantization
+
+
+# The model of the current worker process (or, without worker processes, of
+# this process), loaded by load_worker_model
+worker_model = None
+
+
+def load_t5_oneline_summary(quantize=False):
+    import simplet5
+
+    model = simplet5.SimpleT5()
+    model.load_model("t5", "snrspeaks/t5-one-line-summary")
+    if quantize:
+        model = quantization.quantize(model)
+    return model
+
+
+def load_worker_model(quantize):
+    global worker_model
+    worker_model = load_t5_oneline_summary(quantize)
+
+
+def generate(model, texts, max_input_length=512):
+    # One padded generate call for all texts instead of one predict per text
+    if not texts:
+        return []
+    inputs = model.tokenizer(
+        texts, return_tensors="pt", padding=True, truncation=True, max_length=max_input_length
+    ).to(model.device)
+    outputs = model.model.generate(
+        input_ids=inputs["input_ids"],
+        attention_mask=inputs["attention_mask"],
+        max_length=512,
+        num_beams=2,
+        top_k=50,
+        top_p=0.95,
+        do_sample=True,
+        repetition_penalty=2.5,
+        length_penalty=1.0,
+        early_stopping=True,
+    )
+    return model.tokenizer.batch_decode(
+        outputs, skip_special_tokens=True, clean_up_tokenization_spaces=True
+    )
+
+
+def worker_generate(texts, max_input_length):
+    return generate(worker_model, texts, max_input_length)
+
+
+def worker_ready():
+    return worker_model is not None
+
+
+class T5Summarizer:
+    # Runs T5 generation off the event loop, in `processes` worker processes
+    # that each load their own copy of the model, so summaries for several
+    # sessions are generated in parallel and without holding the GIL of the
+    # serving process. With processes=0 the model runs in a single thread of
+    # this process instead.
+    #
+    # Texts are generated in batches of at most batch_size, and truncated to
+    # max_input_length tokens.
+
+    def __init__(self, processes=1, quantize=False, max_input_length=512, batch_size=8):
+        self.processes = processes
+        self.max_input_length = max_input_length
+        self.batch_size = batch_size
+        if processes:
+            self.executor = ProcessPoolExecutor(
+                max_workers=processes,
+                # Forking a process that has loaded torch can deadlock
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_worker_model,
+                initargs=(quantize,),
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, initializer=load_worker_model, initargs=(quantize,)
+            )
+
+    def warm(self):
+        # Starts the workers and blocks until one of them has loaded the model
+        return self.executor.submit(worker_ready).result()
+
+    async def summarize(self, texts):
+        loop = asyncio.get_running_loop()
+        batches = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self.executor, worker_generate, batch, self.max_input_length
+                )
+                for batch in batches
+            ]
+        )
+        return [summary for batch_summaries in results for summary in batch_summaries]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
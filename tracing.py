@@ -0,0 +1,136 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_time_ns: int
+    attributes: Dict = field(default_factory=dict)
+    duration: Optional[float] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        self.duration = (time.time_ns() - self.start_time_ns) / 1e9
+
+    def to_dict(self):
+        # Field names follow the OpenTelemetry span data model
+        end_time_ns = self.start_time_ns + int((self.duration or 0.0) * 1e9)
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time_unix_nano": self.start_time_ns,
+            "end_time_unix_nano": end_time_ns,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+@dataclass
+class Trace:
+    trace_id: str
+    spans: List[Span] = field(default_factory=list)
+
+    @property
+    def root(self):
+        return self.spans[0]
+
+    def stage_timings(self):
+        # Seconds per direct child of the root span, summed over repeats
+        timings = {}
+        for span in self.spans:
+            if span.parent_id == self.root.span_id and span.duration is not None:
+                timings[span.name] = timings.get(span.name, 0.0) + span.duration
+        return timings
+
+    def to_dicts(self):
+        return [span.to_dict() for span in self.spans]
+
+    def to_json(self):
+        return json.dumps(self.to_dicts())
+
+
+def start_span(name, **attributes):
+    # Records a span under the current span of the active trace without
+    # making it current; call end() on it when done. For code that can't
+    # keep a `with span(...)` block open, e.g. across a generator's yield.
+    trace = current_trace.get()
+    parent = current_span.get()
+    new_span = Span(
+        name=name,
+        trace_id=trace.trace_id if trace else "",
+        span_id=uuid.uuid4().hex[:16],
+        parent_id=parent.span_id if parent else None,
+        start_time_ns=time.time_ns(),
+        attributes=attributes,
+    )
+    if trace is not None:
+        trace.spans.append(new_span)
+    return new_span
+
+
+@contextmanager
+def span(name, **attributes):
+    # Records a timed span under the current span of the active trace. Outside
+    # of a trace the span is timed but not recorded anywhere.
+    new_span = start_span(name, **attributes)
+    token = current_span.set(new_span)
+    start = time.perf_counter()
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.set(error=repr(e))
+        raise
+    finally:
+        new_span.duration = time.perf_counter() - start
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # Closed from another context, e.g. an abandoned async generator
+            # finalized by asyncio; that context is discarded anyway
+            pass
+
+
+@contextmanager
+def trace(name, **attributes):
+    new_trace = Trace(trace_id=uuid.uuid4().hex)
+    trace_token = current_trace.set(new_trace)
+    span_token = current_span.set(None)
+    try:
+        with span(name, **attributes):
+            yield new_trace
+    finally:
+        current_span.reset(span_token)
+        current_trace.reset(trace_token)
+
+
+export_lock = threading.Lock()
+
+
+def export(trace, path=None):
+    # Appends the trace as one JSON line to path (default: the
+    # fast_claims_trace_path environment variable), if set
+    path = path or os.environ.get("fast_claims_trace_path")
+    if not path:
+        return
+    with export_lock, open(path, "a") as f:
+        f.write(trace.to_json() + "\n")